@@ -3,30 +3,247 @@ from flask_socketio import SocketIO, emit, join_room, leave_room, rooms
 import json
 
 import os
+import sys
 import uuid
 import time
+import threading
+from bisect import bisect_right
+from array import array
+from collections import Counter, deque
+from functools import wraps
 from datetime import datetime, timedelta
 from threading import Lock
 
+from poetry_corpus import PoetryCorpus, corpus_index_path, index_is_current, split_lines
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'jianbing_game_secret_key_2024'
 # 使用threading模式而不是eventlet，避免Python 3.12+兼容性问题
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
-# 数据存储文件
+# 诗词库 - 可选的本地诗词库文件（chinese-poetry JSON格式），索引需通过 python poetry_corpus.py 离线构建，服务只通过mmap打开
+POETRY_CORPUS_FILE = 'poetry_corpus.json'
+REQUIRE_CORPUS_MATCH = False  # 为True时，只接受诗词库中存在的诗句
+poetry_corpus = None
+poetry_corpus_loaded = False
+poetry_corpus_lock = Lock()
+
+# 慢请求日志 - Flask路由或Socket.IO事件耗时超过阈值（秒）时记录
+SLOW_REQUEST_THRESHOLD = 0.2
+SLOW_LOG_EXCLUDED_ENDPOINTS = {'run_profiler'}  # 按设计会持续较长时间的接口，不计入慢请求日志
+slow_request_log = deque(maxlen=200)
+request_timing = threading.local()  # 当前线程正在处理的请求累计的锁等待时间
+
+# 采样分析器 - 单次采样最长时间（秒），同一时刻只允许一个采样任务
+PROFILE_MAX_SECONDS = 60
+profile_lock = Lock()
+
+class TimedLock:
+    """记录获取等待时间的锁，等待时间累加到当前请求用于慢请求日志"""
+    
+    def __init__(self):
+        self._lock = Lock()
+    
+    def __enter__(self):
+        start = time.perf_counter()
+        self._lock.acquire()
+        request_timing.lock_wait = getattr(request_timing, 'lock_wait', 0.0) + time.perf_counter() - start
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._lock.release()
+
+# 网格大小
+GRID_SIZE = 100
+# 棋盘占用格子数不超过该值时用稀疏字典保存网格，超过后转为一维数组
+SPARSE_CELL_LIMIT = 600
+
+def parse_timestamp(value):
+    """将ISO时间字符串或数字转换为时间戳"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except (TypeError, ValueError):
+        return time.time()
+
+def intern_str(value):
+    """驻留字符串，非字符串原样返回"""
+    return sys.intern(value) if isinstance(value, str) else value
+
+def format_timestamp(ts):
+    """将时间戳转换为ISO时间字符串（仅在接口和持久化边界使用）"""
+    return datetime.fromtimestamp(ts).isoformat()
+
+class Poem:
+    """诗句记录，ID、作者、颜色等重复字符串经过驻留，创建时间以时间戳保存"""
+    __slots__ = ('id', 'text', 'direction', 'x', 'y', 'color', 'connected_to', 'author', 'created_at', 'source')
+    
+    def __init__(self, poem_id, text, direction, x, y, color, connected_to=(), author='', created_at=None,
+                 source=None):
+        self.id = intern_str(poem_id)
+        self.text = text
+        self.direction = intern_str(direction)
+        self.x = x
+        self.y = y
+        self.color = intern_str(color)
+        self.connected_to = tuple(intern_str(pid) for pid in connected_to)
+        self.author = intern_str(author)
+        self.created_at = created_at if created_at is not None else time.time()
+        self.source = tuple(intern_str(part) for part in source) if source else None  # (标题, 作者)
+    
+    @classmethod
+    def from_dict(cls, data):
+        """从接口/存储格式创建诗句"""
+        source = data.get('source')
+        return cls(
+            data['id'],
+            data['text'],
+            data['direction'],
+            data['startPosition']['x'],
+            data['startPosition']['y'],
+            data['color'],
+            data.get('connectedTo', []),
+            data.get('author', ''),
+            parse_timestamp(data.get('created_at')),
+            (source['title'], source['poet']) if source else None
+        )
+    
+    def to_dict(self):
+        """转换为接口/存储格式"""
+        data = {
+            'id': self.id,
+            'text': self.text,
+            'direction': self.direction,
+            'startPosition': {'x': self.x, 'y': self.y},
+            'color': self.color,
+            'connectedTo': list(self.connected_to),
+            'author': self.author,
+            'created_at': format_timestamp(self.created_at)
+        }
+        if self.source:
+            data['source'] = {'title': self.source[0], 'poet': self.source[1]}
+        return data
+
+class GameBoard:
+    """房间棋盘：诗句列表加网格
+    
+    网格中每格保存诗句序号（从1开始），字符、诗句ID和颜色由诗句推导。
+    占用格子较少时网格为 {格子下标: 序号} 的稀疏字典，超过 SPARSE_CELL_LIMIT 后转为一维数组。
+    """
+    __slots__ = ('poems', 'cells', 'last_updated')
+    
+    def __init__(self, last_updated=None):
+        self.poems = []
+        self.cells = {}
+        self.last_updated = last_updated if last_updated is not None else time.time()
+    
+    @classmethod
+    def from_dict(cls, data):
+        """从存储格式创建棋盘，网格由诗句重新铺设（兼容旧数据中的grid字段）"""
+        board = cls(parse_timestamp(data.get('last_updated')))
+        for poem_data in data.get('poems', []):
+            poem = Poem.from_dict(poem_data)
+            board.poems.append(poem)
+            update_grid(board, poem, len(board.poems))
+        return board
+    
+    def to_dict(self):
+        """转换为存储格式"""
+        return {
+            'poems': [poem.to_dict() for poem in self.poems],
+            'last_updated': format_timestamp(self.last_updated)
+        }
+    
+    def to_grid(self):
+        """转换为接口使用的二维网格"""
+        poems = self.poems
+        return cells_to_grid(self.cells, lambda number: poems[number - 1])
+
+class OnlineUser:
+    """在线用户记录"""
+    __slots__ = ('username', 'room_code', 'join_time')
+    
+    def __init__(self, username, room_code, join_time):
+        self.username = sys.intern(username)
+        self.room_code = sys.intern(room_code)
+        self.join_time = join_time
+
+def dense_cells(cells):
+    """将稀疏网格字典转换为一维数组（0表示空）"""
+    dense = array('I', [0]) * (GRID_SIZE * GRID_SIZE)
+    for index, number in cells.items():
+        dense[index] = number
+    return dense
+
+def iter_cells(cells):
+    """遍历网格中已占用的格子，返回 (格子下标, 序号)"""
+    if isinstance(cells, dict):
+        return cells.items()
+    return ((index, number) for index, number in enumerate(cells) if number)
+
+def cells_to_grid(cells, poem_at):
+    """将网格展开为二维网格，poem_at 根据序号返回诗句"""
+    grid = [[None] * GRID_SIZE for _ in range(GRID_SIZE)]
+    for index, number in iter_cells(cells):
+        poem = poem_at(number)
+        y, x = divmod(index, GRID_SIZE)
+        offset = x - poem.x if poem.direction == 'horizontal' else y - poem.y
+        grid[y][x] = {
+            'char': poem.text[offset],
+            'poem_id': poem.id,
+            'color': poem.color
+        }
+    return grid
+
+# 数据存储文件（房间和历史文件可通过同名环境变量指定，需在导入前设置）
 DATA_FILE = 'game_data.json'
-ROOMS_FILE = 'rooms_data.json'
+ROOMS_FILE = os.environ.get('ROOMS_FILE', 'rooms_data.json')
+HISTORY_FILE = os.environ.get('HISTORY_FILE', 'rooms_history.jsonl')
 
 # 内存中的房间数据
 rooms_data = {}
-rooms_lock = Lock()
+rooms_lock = TimedLock()
 
 # 用户会话管理
 user_sessions = {}
 
 # 在线用户管理 - 存储socket_id到用户信息的映射
-online_users = {}  # {socket_id: {'username': str, 'room_code': str, 'join_time': timestamp}}
-online_users_lock = Lock()
+online_users = {}  # {socket_id: OnlineUser}
+online_users_lock = TimedLock()
+
+# 棋盘历史 - 每个房间一份追加写入的事件日志，重置游戏不会清除
+HISTORY_CHECKPOINT_INTERVAL = 50  # 每隔多少个事件保存一次棋盘检查点
+room_histories = {}  # {room_code: 见 new_room_history()}
+history_needs_compact = False  # 加载时发现已删除房间或重新编号的记录，由启动入口调用 compact_room_histories() 重写文件
+history_lock = TimedLock()
+
+# 速率限制配置 - 每个socket、每种事件一个令牌桶：{事件名: (每秒补充令牌数, 桶容量)}
+RATE_LIMITS = {
+    'start_editing': (2, 5),
+    'update_editing_position': (10, 20),
+    'request_admin_rooms_info': (0.5, 3),
+    'spectate_room': (1, 3),
+}
+socket_rate_buckets = {}  # {socket_id: {event: [tokens, last_refill]}}
+rate_limit_counters = Counter()  # {'事件名:触发类型': 次数}
+rate_limit_lock = Lock()
+
+# 慢速客户端保护 - 单个socket待发送数据包超过上限时跳过可合并的编辑状态广播
+OUTBOUND_QUEUE_LIMIT = 64
+# 编辑位置广播的最小间隔（秒），间隔内的多次光标移动合并为一次广播
+EDITING_BROADCAST_INTERVAL = 0.1
+last_editing_broadcast = {}  # {room_code: 上次广播时间}
+pending_editing_rooms = {}  # {room_code: 计划广播时间}
+lagging_sockets = {}  # {socket_id: room_code} 被跳过、待补发最新编辑状态的socket
+editing_broadcast_lock = Lock()
+
+# 观战模式 - 观众不计入玩家、统计和编辑状态，只按固定频率接收批量的棋盘变化
+SPECTATOR_BATCH_INTERVAL = 2.0  # 批量推送间隔（秒）
+spectators = {}  # {socket_id: room_code}
+spectator_counts = Counter()  # {room_code: 观众数}
+spectator_pending = {}  # {room_code: [待推送的棋盘事件]}
+spectators_lock = Lock()
 
 def load_game_data():
     """加载游戏数据"""
@@ -44,42 +261,251 @@ def save_game_data(data):
     with open(DATA_FILE, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
 
+def room_to_dict(room_data):
+    """将房间转换为存储格式"""
+    data = dict(room_data)
+    data['game_data'] = room_data['game_data'].to_dict()
+    data['created_at'] = format_timestamp(room_data['created_at'])
+    return data
+
+def room_from_dict(data):
+    """从存储格式创建房间"""
+    room_data = dict(data)
+    room_data['players'] = [sys.intern(player) for player in data['players']]
+    room_data['game_data'] = GameBoard.from_dict(data['game_data'])
+    room_data['created_at'] = parse_timestamp(data.get('created_at'))
+    return room_data
+
 def load_rooms_data():
     """加载房间数据"""
     if os.path.exists(ROOMS_FILE):
         with open(ROOMS_FILE, 'r', encoding='utf-8') as f:
-            return json.load(f)
+            return {room_code: room_from_dict(data) for room_code, data in json.load(f).items()}
     return {}
 
 def save_rooms_data():
     """保存房间数据"""
     with open(ROOMS_FILE, 'w', encoding='utf-8') as f:
-        json.dump(rooms_data, f, ensure_ascii=False, indent=2)
+        json.dump({room_code: room_to_dict(room_data) for room_code, room_data in rooms_data.items()},
+                  f, ensure_ascii=False, indent=2)
+
+def record_limit_hit(key, count=1):
+    """记录限流/丢弃计数"""
+    with rate_limit_lock:
+        rate_limit_counters[key] += count
+
+def consume_rate_token(socket_id, event):
+    """按令牌桶检查socket的事件频率，超出限制返回False"""
+    limit = RATE_LIMITS.get(event)
+    if not limit:
+        return True
+    
+    rate, capacity = limit
+    now = time.monotonic()
+    with rate_limit_lock:
+        buckets = socket_rate_buckets.setdefault(socket_id, {})
+        bucket = buckets.get(event)
+        if bucket is None:
+            bucket = buckets[event] = [capacity, now]
+        
+        tokens = min(capacity, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens < 1:
+            bucket[0] = tokens
+            rate_limit_counters[f'{event}:throttled'] += 1
+            return False
+        
+        bucket[0] = tokens - 1
+        return True
+
+def forget_socket_limits(socket_id):
+    """清理socket的限流与积压记录"""
+    with rate_limit_lock:
+        socket_rate_buckets.pop(socket_id, None)
+    with editing_broadcast_lock:
+        lagging_sockets.pop(socket_id, None)
+
+def get_outbound_backlog(socket_id):
+    """获取socket在engineio层尚未发出的数据包数量"""
+    eio_sid = socketio.server.manager.eio_sid_from_sid(socket_id, '/')
+    eio_socket = socketio.server.eio.sockets.get(eio_sid) if eio_sid else None
+    if eio_socket is None:
+        return 0
+    return eio_socket.queue.qsize()
+
+def broadcast_editing_status(room_code, editing_users):
+    """广播编辑状态，跳过发送队列已积压的慢速客户端"""
+    try:
+        participants = list(socketio.server.manager.get_participants('/', room_code))
+    except KeyError:
+        participants = []
+    slow_sids = [sid for sid, _ in participants
+                 if get_outbound_backlog(sid) >= OUTBOUND_QUEUE_LIMIT]
+    
+    with editing_broadcast_lock:
+        last_editing_broadcast[room_code] = time.monotonic()
+        pending_editing_rooms.pop(room_code, None)
+        for sid in slow_sids:
+            lagging_sockets[sid] = room_code
+    
+    if slow_sids:
+        record_limit_hit('editing_status_update:dropped', len(slow_sids))
+    
+    socketio.emit('editing_status_update', {
+        'editing_users': editing_users
+    }, room=room_code, skip_sid=slow_sids or None)
+
+def schedule_editing_broadcast(room_code, editing_users, throttled=False):
+    """节流广播编辑状态，间隔内或超出速率限制的更新由后台线程合并发送"""
+    now = time.monotonic()
+    with editing_broadcast_lock:
+        last = last_editing_broadcast.get(room_code, 0)
+        coalesced = throttled or now - last < EDITING_BROADCAST_INTERVAL
+        if coalesced:
+            pending_editing_rooms.setdefault(room_code, last + EDITING_BROADCAST_INTERVAL)
+    
+    if coalesced:
+        record_limit_hit('editing_status_update:coalesced')
+        return
+    
+    broadcast_editing_status(room_code, editing_users)
+
+def record_if_slow(kind, handler, room_code, start):
+    """请求耗时超过阈值时写入慢请求日志"""
+    duration = time.perf_counter() - start
+    if duration < SLOW_REQUEST_THRESHOLD:
+        return
+    
+    entry = {
+        'kind': kind,
+        'handler': handler,
+        'room_code': room_code,
+        'duration_ms': round(duration * 1000, 2),
+        'lock_wait_ms': round(getattr(request_timing, 'lock_wait', 0.0) * 1000, 2),
+        'time': datetime.now().isoformat()
+    }
+    slow_request_log.append(entry)
+    print(f"慢请求: {kind} {handler} 房间={room_code} 耗时={entry['duration_ms']}ms 锁等待={entry['lock_wait_ms']}ms")
+
+def timed_event(handler):
+    """Socket.IO事件计时装饰器，超过阈值时记录慢事件"""
+    @wraps(handler)
+    def wrapper(*args):
+        request_timing.lock_wait = 0.0
+        start = time.perf_counter()
+        try:
+            return handler(*args)
+        finally:
+            data = args[0] if args and isinstance(args[0], dict) else {}
+            record_if_slow('socket', handler.__name__, data.get('room_code'), start)
+    return wrapper
+
+def sample_stacks(seconds, interval):
+    """按固定间隔采样所有线程的调用栈，返回折叠格式的栈计数和采样次数"""
+    stacks = Counter()
+    own_ident = threading.get_ident()
+    deadline = time.monotonic() + seconds
+    samples = 0
+    
+    while time.monotonic() < deadline:
+        thread_names = {t.ident: t.name for t in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                frames.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            frames.append(thread_names.get(ident, str(ident)))
+            stacks[';'.join(reversed(frames))] += 1
+        samples += 1
+        time.sleep(interval)
+    
+    return stacks, samples
+
+def spectator_room(room_code):
+    """观众所在的Socket.IO房间名，与玩家房间分开，观众收不到光标和统计广播"""
+    return f'{room_code}:spectators'
+
+def queue_spectator_event(room_code, event, data):
+    """将棋盘变化加入观众的待推送批次，重置会丢弃之前未推送的变化"""
+    with spectators_lock:
+        if not spectator_counts.get(room_code):
+            return
+        if event == 'game_reset':
+            spectator_pending[room_code] = []
+        spectator_pending.setdefault(room_code, []).append({'event': event, 'data': data})
+
+def remove_spectator(socket_id):
+    """移除观众记录，返回其观战的房间码"""
+    with spectators_lock:
+        room_code = spectators.pop(socket_id, None)
+        if room_code is not None:
+            spectator_counts[room_code] -= 1
+            if spectator_counts[room_code] <= 0:
+                del spectator_counts[room_code]
+                spectator_pending.pop(room_code, None)
+        return room_code
+
+def open_poetry_corpus():
+    """打开离线构建的诗词库索引，索引缺失或打开失败时给出提示并返回None"""
+    index_path = corpus_index_path(POETRY_CORPUS_FILE)
+    if not os.path.exists(index_path):
+        if os.path.exists(POETRY_CORPUS_FILE):
+            print(f'诗词库索引不存在，请先执行 python poetry_corpus.py {POETRY_CORPUS_FILE}')
+        return None
+    
+    if os.path.exists(POETRY_CORPUS_FILE) and not index_is_current(POETRY_CORPUS_FILE):
+        print(f'警告: 诗词库索引比诗词库旧，请重新执行 python poetry_corpus.py {POETRY_CORPUS_FILE}')
+    try:
+        corpus = PoetryCorpus(index_path)
+    except (OSError, ValueError) as e:
+        print(f'诗词库索引打开失败: {e}')
+        return None
+    print(f'诗词库加载完成，共 {corpus.line_count} 句')
+    return corpus
+
+def init_poetry_corpus():
+    """启动时打开诗词库索引，服务进程中不构建索引"""
+    global poetry_corpus, poetry_corpus_loaded
+    with poetry_corpus_lock:
+        poetry_corpus = open_poetry_corpus()
+        poetry_corpus_loaded = True
+
+def get_poetry_corpus():
+    """获取诗词库，未配置或索引不可用时返回None"""
+    global poetry_corpus, poetry_corpus_loaded
+    with poetry_corpus_lock:
+        if not poetry_corpus_loaded:
+            poetry_corpus = open_poetry_corpus()
+            poetry_corpus_loaded = True
+        return poetry_corpus
 
 def generate_room_code():
     """生成6位房间码"""
     import random
     return str(random.randint(100000, 999999))
 
+def new_room_data(room_code, creator_name):
+    """创建新房间的内存数据"""
+    return {
+        'code': room_code,
+        'creator': sys.intern(creator_name),
+        'players': [sys.intern(creator_name)],
+        'game_data': GameBoard(),
+        'created_at': time.time(),
+        'last_activity': time.time(),
+        'editing_users': {}  # 记录正在编辑的用户
+    }
+
 def create_room(room_code, creator_name):
     """创建房间"""
     with rooms_lock:
         if room_code in rooms_data:
             return False
         
-        rooms_data[room_code] = {
-            'code': room_code,
-            'creator': creator_name,
-            'players': [creator_name],
-            'game_data': {
-                'poems': [],
-                'grid': [[None for _ in range(100)] for _ in range(100)],
-                'last_updated': datetime.now().isoformat()
-            },
-            'created_at': datetime.now().isoformat(),
-            'last_activity': time.time(),
-            'editing_users': {}  # 记录正在编辑的用户
-        }
+        rooms_data[room_code] = new_room_data(room_code, creator_name)
         save_rooms_data()
         return True
 
@@ -92,8 +518,8 @@ def get_online_users_in_room(room_code):
     with online_users_lock:
         online_in_room = []
         for socket_id, user_info in online_users.items():
-            if user_info['room_code'] == room_code:
-                online_in_room.append(user_info['username'])
+            if user_info.room_code == room_code:
+                online_in_room.append(user_info.username)
         return online_in_room
 
 def get_player_stats(room_code):
@@ -103,11 +529,10 @@ def get_player_stats(room_code):
             return {}
         
         room_data = rooms_data[room_code]
-        poems = room_data['game_data']['poems']
+        poems = room_data['game_data'].poems
         
         # 统计每个玩家的诗词数量
-        from collections import Counter
-        poem_counts = Counter(poem['author'] for poem in poems)
+        poem_counts = Counter(poem.author for poem in poems)
         
         # 获取在线用户列表
         online_users_list = get_online_users_in_room(room_code)
@@ -124,6 +549,9 @@ def get_player_stats(room_code):
 
 def get_all_rooms_info():
     """获取所有房间信息（管理员专用）"""
+    with spectators_lock:
+        counts = dict(spectator_counts)
+    
     with rooms_lock:
         rooms_info = []
         for room_code, room_data in rooms_data.items():
@@ -133,10 +561,11 @@ def get_all_rooms_info():
                     'creator': room_data['creator'],
                     'player_count': len(room_data['players']),
                     'players': room_data['players'],
-                    'created_at': room_data['created_at'],
+                    'created_at': format_timestamp(room_data['created_at']),
                     'last_activity': room_data['last_activity'],
-                    'poem_count': len(room_data['game_data']['poems']),
-                    'editing_count': len(room_data.get('editing_users', {}))
+                    'poem_count': len(room_data['game_data'].poems),
+                    'editing_count': len(room_data.get('editing_users', {})),
+                    'spectator_count': counts.get(room_code, 0)
                 })
         return sorted(rooms_info, key=lambda x: x['last_activity'], reverse=True)
 
@@ -147,7 +576,7 @@ def join_room_by_code(room_code, player_name):
             return False
         
         if player_name not in rooms_data[room_code]['players']:
-            rooms_data[room_code]['players'].append(player_name)
+            rooms_data[room_code]['players'].append(sys.intern(player_name))
             rooms_data[room_code]['last_activity'] = time.time()
             save_rooms_data()
         return True
@@ -165,6 +594,7 @@ def leave_room_by_code(room_code, player_name):
             # 如果房间没人了，删除房间
             if not rooms_data[room_code]['players']:
                 del rooms_data[room_code]
+                forget_room(room_code)
             save_rooms_data()
 
 def get_room_data(room_code):
@@ -180,6 +610,21 @@ def update_room_game_data(room_code, game_data):
             rooms_data[room_code]['last_activity'] = time.time()
             save_rooms_data()
 
+def forget_room(room_code):
+    """房间删除后清理其历史、编辑状态广播和观众记录，并让观众离开观战房间，调用方需持有 rooms_lock"""
+    drop_room_history(room_code)
+    with editing_broadcast_lock:
+        last_editing_broadcast.pop(room_code, None)
+        pending_editing_rooms.pop(room_code, None)
+        for socket_id in [sid for sid, code in lagging_sockets.items() if code == room_code]:
+            del lagging_sockets[socket_id]
+    with spectators_lock:
+        for socket_id in [sid for sid, code in spectators.items() if code == room_code]:
+            del spectators[socket_id]
+        spectator_counts.pop(room_code, None)
+        spectator_pending.pop(room_code, None)
+    socketio.close_room(spectator_room(room_code))
+
 def cleanup_inactive_rooms():
     """清理不活跃的房间（超过12小时无活动）"""
     current_time = time.time()
@@ -191,10 +636,29 @@ def cleanup_inactive_rooms():
         
         for room_code in inactive_rooms:
             del rooms_data[room_code]
+            forget_room(room_code)
         
         if inactive_rooms:
             save_rooms_data()
 
+@app.before_request
+def start_request_timer():
+    """记录请求开始时间"""
+    request_timing.lock_wait = 0.0
+    request_timing.start = time.perf_counter()
+
+@app.teardown_request
+def log_slow_request(exc):
+    """请求结束时检查是否为慢请求"""
+    start = getattr(request_timing, 'start', None)
+    if start is None:
+        return
+    request_timing.start = None
+    if request.endpoint in SLOW_LOG_EXCLUDED_ENDPOINTS:
+        return
+    room_code = (request.view_args or {}).get('room_code')
+    record_if_slow('http', request.endpoint, room_code, start)
+
 @app.route('/')
 def index():
     """主页面"""
@@ -281,7 +745,7 @@ def get_room_info(room_code):
             'code': room_data['code'],
             'creator': room_data['creator'],
             'players': room_data['players'],
-            'created_at': room_data['created_at']
+            'created_at': format_timestamp(room_data['created_at'])
         }
     })
 
@@ -324,6 +788,80 @@ def get_admin_rooms_info():
         'total_players': sum(room['player_count'] for room in rooms_info)
     })
 
+@app.route('/api/admin/rate_limits')
+def get_rate_limit_stats():
+    """获取限流配置与触发计数（管理员专用）"""
+    if 'username' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    username = session['username']
+    if username != '管理员':
+        return jsonify({'success': False, 'message': '权限不足'})
+    
+    with rate_limit_lock:
+        counters = dict(rate_limit_counters)
+    
+    return jsonify({
+        'success': True,
+        'limits': {event: {'rate': rate, 'burst': capacity}
+                   for event, (rate, capacity) in RATE_LIMITS.items()},
+        'outbound_queue_limit': OUTBOUND_QUEUE_LIMIT,
+        'counters': counters
+    })
+
+@app.route('/api/admin/slow_log')
+def get_slow_request_log():
+    """获取慢请求与慢事件日志（管理员专用）"""
+    if 'username' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    username = session['username']
+    if username != '管理员':
+        return jsonify({'success': False, 'message': '权限不足'})
+    
+    return jsonify({
+        'success': True,
+        'threshold_ms': SLOW_REQUEST_THRESHOLD * 1000,
+        'entries': list(slow_request_log)
+    })
+
+@app.route('/api/admin/profile', methods=['POST'])
+def run_profiler():
+    """采样所有线程调用栈N秒，返回火焰图折叠格式（管理员专用）"""
+    if 'username' not in session:
+        return jsonify({'success': False, 'message': '请先登录'})
+    
+    username = session['username']
+    if username != '管理员':
+        return jsonify({'success': False, 'message': '权限不足'})
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = min(float(data.get('seconds', 10)), PROFILE_MAX_SECONDS)
+        interval = float(data.get('interval_ms', 10)) / 1000
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'message': '参数无效'})
+    if seconds <= 0 or interval <= 0:
+        return jsonify({'success': False, 'message': '参数无效'})
+    
+    if not profile_lock.acquire(blocking=False):
+        return jsonify({'success': False, 'message': '已有采样任务在运行'})
+    try:
+        stacks, samples = sample_stacks(seconds, interval)
+    finally:
+        profile_lock.release()
+    
+    collapsed = '\n'.join(f'{stack} {count}' for stack, count in stacks.most_common())
+    if data.get('format') == 'text':
+        return collapsed + '\n', 200, {'Content-Type': 'text/plain; charset=utf-8'}
+    
+    return jsonify({
+        'success': True,
+        'seconds': seconds,
+        'samples': samples,
+        'stacks': collapsed
+    })
+
 @app.route('/api/admin/join_admin_room', methods=['POST'])
 def join_admin_room():
     """加入管理员房间"""
@@ -379,16 +917,19 @@ def delete_room():
         room_data = rooms_data[room_code]
         players = room_data['players'].copy()  # 复制玩家列表
         
-        # 删除房间
-        del rooms_data[room_code]
-        save_rooms_data()
-        
-        # 通知房间内所有玩家房间已被删除
-        socketio.emit('room_deleted', {
+        # 通知房间内所有玩家和观众房间已被删除（观众随后被移出观战房间）
+        deleted_message = {
             'room_code': room_code,
             'message': f'房间 {room_code} 已被管理员删除',
             'deleted_by': username
-        }, room=room_code)
+        }
+        socketio.emit('room_deleted', deleted_message, room=room_code)
+        socketio.emit('room_deleted', deleted_message, room=spectator_room(room_code))
+        
+        # 删除房间
+        del rooms_data[room_code]
+        forget_room(room_code)
+        save_rooms_data()
         
         return jsonify({
             'success': True,
@@ -403,7 +944,7 @@ def get_poems(room_code):
     if not room_data:
         return jsonify({'success': False, 'message': '房间不存在'})
     
-    return jsonify(room_data['game_data']['poems'])
+    return jsonify([poem.to_dict() for poem in room_data['game_data'].poems])
 
 @app.route('/api/poems/<room_code>', methods=['POST'])
 def add_poem(room_code):
@@ -421,35 +962,63 @@ def add_poem(room_code):
     
     poem_data = request.json
     
+    # 校验会影响网格铺设和存储的字段
+    text = poem_data.get('text')
+    direction = poem_data.get('direction')
+    position = poem_data.get('startPosition')
+    color = poem_data.get('color')
+    connected_to = poem_data.get('connectedTo') or []
+    if not isinstance(text, str) or not text:
+        return jsonify({'success': False, 'message': '诗句不能为空'})
+    if direction not in ('horizontal', 'vertical'):
+        return jsonify({'success': False, 'message': '诗句方向无效'})
+    if (not isinstance(position, dict)
+            or not all(type(position.get(axis)) is int for axis in ('x', 'y'))):
+        return jsonify({'success': False, 'message': '诗句位置无效'})
+    if not isinstance(color, str):
+        return jsonify({'success': False, 'message': '诗句颜色无效'})
+    if not isinstance(connected_to, list):
+        return jsonify({'success': False, 'message': '接龙关系无效'})
+    
+    # 诗词库校验与出处标注（各句出自不同诗时只校验，不标注出处）
+    corpus = get_poetry_corpus()
+    source = corpus.lookup(text) if corpus else None
+    if corpus and REQUIRE_CORPUS_MATCH and source is None and not corpus.contains(text):
+        return jsonify({'success': False, 'message': '诗句不在诗词库中'})
+    
     # 生成唯一ID
-    poem_id = f"poem_{len(room_data['game_data']['poems']) + 1:03d}_{int(time.time())}"
+    poem_id = f"poem_{len(room_data['game_data'].poems) + 1:03d}_{int(time.time())}"
     
     # 创建新诗句对象
-    new_poem = {
-        'id': poem_id,
-        'text': poem_data['text'],
-        'direction': poem_data['direction'],
-        'startPosition': poem_data['startPosition'],
-        'color': poem_data['color'],
-        'connectedTo': poem_data.get('connectedTo', []),
-        'author': username,
-        'created_at': datetime.now().isoformat()
-    }
-    
-    # 添加到诗句列表
-    room_data['game_data']['poems'].append(new_poem)
-    
-    # 更新网格
-    update_grid(room_data['game_data'], new_poem)
+    new_poem = Poem(
+        poem_id,
+        text,
+        direction,
+        position['x'],
+        position['y'],
+        color,
+        connected_to,
+        username,
+        source=source
+    )
+    
+    # 添加到诗句列表、更新网格并记录历史，同一房间的并发提交在棋盘和历史中顺序一致
+    with rooms_lock:
+        board = room_data['game_data']
+        board.poems.append(new_poem)
+        update_grid(board, new_poem, len(board.poems))
+        record_history_event(room_code, 'poem', new_poem)
     
     # 保存房间数据
     update_room_game_data(room_code, room_data['game_data'])
     
     # 广播给房间内所有用户
+    poem_json = new_poem.to_dict()
     socketio.emit('poem_added', {
-        'poem': new_poem,
+        'poem': poem_json,
         'author': username
     }, room=room_code)
+    queue_spectator_event(room_code, 'poem_added', {'poem': poem_json})
     
     # 广播更新的玩家统计
     player_stats = get_player_stats(room_code)
@@ -457,7 +1026,7 @@ def add_poem(room_code):
         'player_stats': player_stats
     }, room=room_code)
     
-    return jsonify({'success': True, 'poem': new_poem})
+    return jsonify({'success': True, 'poem': poem_json})
 
 @app.route('/api/grid/<room_code>', methods=['GET'])
 def get_grid(room_code):
@@ -466,7 +1035,72 @@ def get_grid(room_code):
     if not room_data:
         return jsonify({'success': False, 'message': '房间不存在'})
     
-    return jsonify(room_data['game_data']['grid'])
+    return jsonify(room_data['game_data'].to_grid())
+
+@app.route('/api/history/<room_code>', methods=['GET'])
+def get_board_history(room_code):
+    """获取房间在指定序号（seq）或时间点（at）的棋盘状态"""
+    room_data = get_room_data(room_code)
+    if not room_data:
+        return jsonify({'success': False, 'message': '房间不存在'})
+    
+    seq = request.args.get('seq', type=int)
+    at = request.args.get('at')
+    timestamp = None
+    if at:
+        try:
+            timestamp = float(at)
+        except ValueError:
+            try:
+                timestamp = datetime.fromisoformat(at).timestamp()
+            except ValueError:
+                return jsonify({'success': False, 'message': '时间格式无效'})
+    
+    board = get_board_at(room_code, seq=seq, timestamp=timestamp)
+    return jsonify({'success': True, **board})
+
+@app.route('/api/history/<room_code>/timeline', methods=['GET'])
+def get_board_timeline(room_code):
+    """获取房间历史事件概要，用于回放进度条"""
+    room_data = get_room_data(room_code)
+    if not room_data:
+        return jsonify({'success': False, 'message': '房间不存在'})
+    
+    with history_lock:
+        history = room_histories.get(room_code)
+        events = list(zip(history['poems'], history['timestamps'])) if history else []
+    
+    timeline = []
+    for index, (poem, ts) in enumerate(events):
+        item = {'seq': index + 1, 'ts': ts, 'type': 'reset' if poem is None else 'poem'}
+        if poem is not None:
+            item['poem_id'] = poem.id
+            item['author'] = poem.author
+        timeline.append(item)
+    
+    return jsonify({'success': True, 'events': timeline})
+
+@app.route('/api/corpus/search', methods=['GET'])
+def search_corpus():
+    """按前缀（mode=prefix）或子串（mode=substring）查找诗词库中的诗句"""
+    corpus = get_poetry_corpus()
+    if not corpus:
+        return jsonify({'success': False, 'message': '未加载诗词库'})
+    
+    query = ''.join(split_lines(request.args.get('q', '')))
+    if not query:
+        return jsonify({'success': False, 'message': '查询内容不能为空'})
+    
+    mode = request.args.get('mode', 'prefix')
+    limit = max(1, min(request.args.get('limit', 20, type=int), 50))
+    if mode == 'prefix':
+        results = corpus.prefix_search(query, limit)
+    elif mode == 'substring':
+        results = corpus.substring_search(query, limit)
+    else:
+        return jsonify({'success': False, 'message': '查询模式无效'})
+    
+    return jsonify({'success': True, 'results': results})
 
 @app.route('/api/reset/<room_code>', methods=['POST'])
 def reset_game(room_code):
@@ -482,12 +1116,10 @@ def reset_game(room_code):
     if username not in room_data['players']:
         return jsonify({'success': False, 'message': '您不在该房间中'})
     
-    # 重置游戏数据
-    room_data['game_data'] = {
-        'poems': [],
-        'grid': [[None for _ in range(100)] for _ in range(100)],
-        'last_updated': datetime.now().isoformat()
-    }
+    # 重置游戏数据，与新增诗句在同一把锁内记录历史
+    with rooms_lock:
+        room_data['game_data'] = GameBoard()
+        record_history_event(room_code, 'reset')
     
     # 保存房间数据
     update_room_game_data(room_code, room_data['game_data'])
@@ -496,32 +1128,221 @@ def reset_game(room_code):
     socketio.emit('game_reset', {
         'reset_by': username
     }, room=room_code)
+    queue_spectator_event(room_code, 'game_reset', {'reset_by': username})
     
     return jsonify({'success': True})
 
-def update_grid(data, poem):
-    """更新网格数据"""
-    x, y = poem['startPosition']['x'], poem['startPosition']['y']
-    text = poem['text']
+def iter_poem_cells(poem):
+    """遍历诗句在网格中占据的位置，返回 (x, y)"""
+    x, y = poem.x, poem.y
     
-    if poem['direction'] == 'horizontal':
+    if poem.direction == 'horizontal':
         # 横向排列
-        for i, char in enumerate(text):
-            if 0 <= x + i < 100 and 0 <= y < 100:
-                data['grid'][y][x + i] = {
-                    'char': char,
-                    'poem_id': poem['id'],
-                    'color': poem['color']
-                }
+        for i in range(len(poem.text)):
+            if 0 <= x + i < GRID_SIZE and 0 <= y < GRID_SIZE:
+                yield x + i, y
     else:
         # 纵向排列
-        for i, char in enumerate(text):
-            if 0 <= x < 100 and 0 <= y + i < 100:
-                data['grid'][y + i][x] = {
-                    'char': char,
-                    'poem_id': poem['id'],
-                    'color': poem['color']
-                }
+        for i in range(len(poem.text)):
+            if 0 <= x < GRID_SIZE and 0 <= y + i < GRID_SIZE:
+                yield x, y + i
+
+def place_poem(cells, poem, number):
+    """将诗句序号写入网格（稀疏字典或一维数组）"""
+    for x, y in iter_poem_cells(poem):
+        cells[y * GRID_SIZE + x] = number
+
+def update_grid(data, poem, number):
+    """更新网格数据，number 为诗句在 data.poems 中的序号（从1开始）"""
+    place_poem(data.cells, poem, number)
+    if isinstance(data.cells, dict) and len(data.cells) > SPARSE_CELL_LIMIT:
+        data.cells = dense_cells(data.cells)
+
+# 棋盘历史记录
+def new_room_history():
+    """创建空的房间历史，序号0的检查点为空棋盘"""
+    return {
+        'poems': [],                  # 追加写入的事件，第i个事件（序号i+1）为诗句，重置事件为None
+        'timestamps': array('d'),     # 与事件对应的时间戳，用于按时间二分查找
+        'checkpoints': [(0, array('H'), array('I'))]  # 第k个检查点为序号k*间隔时的棋盘：(最近重置序号, 格子下标, 诗句事件序号)
+    }
+
+def replay_history(history, checkpoint_index, seq):
+    """从检查点重放事件到seq，返回 (最近重置序号, {格子下标: 诗句事件序号})"""
+    epoch_start, indexes, seqs = history['checkpoints'][checkpoint_index]
+    cells = dict(zip(indexes, seqs))
+    poems = history['poems']
+    for event_seq in range(checkpoint_index * HISTORY_CHECKPOINT_INTERVAL + 1, seq + 1):
+        poem = poems[event_seq - 1]
+        if poem is None:
+            cells = {}
+            epoch_start = event_seq
+        else:
+            place_poem(cells, poem, event_seq)
+    return epoch_start, cells
+
+def apply_history_event(history, poem, ts):
+    """将事件追加到历史中，每隔固定序号由上一个检查点重放出稀疏的棋盘检查点，返回事件序号"""
+    history['poems'].append(poem)
+    history['timestamps'].append(ts)
+    seq = len(history['poems'])
+    
+    if seq % HISTORY_CHECKPOINT_INTERVAL == 0:
+        epoch_start, cells = replay_history(history, len(history['checkpoints']) - 1, seq)
+        history['checkpoints'].append((epoch_start, array('H', cells.keys()), array('I', cells.values())))
+    return seq
+
+def history_record(room_code, seq, poem, ts):
+    """将历史事件转换为文件中的一行记录"""
+    record = {'room': room_code, 'seq': seq, 'ts': ts, 'type': 'reset' if poem is None else 'poem'}
+    if poem is not None:
+        record['poem'] = poem.to_dict()
+    return record
+
+def append_history_line(record):
+    """追加一行历史记录到文件"""
+    with open(HISTORY_FILE, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+def record_history_event(room_code, event_type, poem=None, ts=None):
+    """记录房间历史事件（poem / reset）"""
+    if event_type == 'reset':
+        poem = None
+    with history_lock:
+        history = room_histories.setdefault(room_code, new_room_history())
+        timestamps = history['timestamps']
+        ts = ts if ts is not None else time.time()
+        if timestamps:
+            ts = max(ts, timestamps[-1])  # 保证时间戳单调，便于二分查找
+        
+        seq = apply_history_event(history, poem, ts)
+        append_history_line(history_record(room_code, seq, poem, ts))
+        return seq
+
+def drop_room_history(room_code):
+    """删除房间历史（房间被删除时调用）"""
+    with history_lock:
+        if room_histories.pop(room_code, None) is not None:
+            append_history_line({'room': room_code, 'type': 'drop'})
+
+def load_room_histories():
+    """从历史文件重建房间历史及检查点，返回 (histories, 文件是否需要压缩)
+    
+    序号不连续的记录（例如旧版本重启后从1重新编号）按文件顺序重新编号并给出警告。
+    """
+    histories = {}
+    line_count = 0
+    renumbered = 0
+    if os.path.exists(HISTORY_FILE):
+        with open(HISTORY_FILE, 'r', encoding='utf-8') as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                line_count += 1
+                record = json.loads(line)
+                room_code = record['room']
+                if record['type'] == 'drop':
+                    histories.pop(room_code, None)
+                    continue
+                history = histories.setdefault(room_code, new_room_history())
+                poem = Poem.from_dict(record['poem']) if record['type'] == 'poem' else None
+                
+                if record['seq'] != len(history['poems']) + 1:
+                    renumbered += 1
+                ts = record['ts']
+                if history['timestamps']:
+                    ts = max(ts, history['timestamps'][-1])
+                apply_history_event(history, poem, ts)
+    
+    if renumbered:
+        print(f'警告: 棋盘历史中有 {renumbered} 条记录序号不连续，已按文件顺序重新编号')
+    
+    live_count = sum(len(history['poems']) for history in histories.values())
+    return histories, renumbered > 0 or line_count > live_count
+
+def compact_history_file():
+    """只保留现存房间的事件重写历史文件"""
+    tmp_path = HISTORY_FILE + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        for room_code, history in room_histories.items():
+            for index, (poem, ts) in enumerate(zip(history['poems'], history['timestamps'])):
+                f.write(json.dumps(history_record(room_code, index + 1, poem, ts), ensure_ascii=False) + '\n')
+    os.replace(tmp_path, HISTORY_FILE)
+
+def init_room_histories():
+    """加载棋盘历史（只读，导入时执行），需要压缩时只做标记"""
+    global history_needs_compact
+    with history_lock:
+        histories, needs_compact = load_room_histories()
+        room_histories.clear()
+        room_histories.update(histories)
+        history_needs_compact = needs_compact
+
+def compact_room_histories():
+    """启动时压缩历史文件，去掉已删除房间的记录并写入重新编号后的序号"""
+    global history_needs_compact
+    with history_lock:
+        if history_needs_compact:
+            compact_history_file()
+            history_needs_compact = False
+
+def seed_room_histories():
+    """为没有历史记录的已有房间补录当前诗句，已有历史的当前局与棋盘共用诗句对象"""
+    with rooms_lock:
+        boards = {room_code: list(room_data['game_data'].poems) for room_code, room_data in rooms_data.items()}
+    
+    missing = []
+    with history_lock:
+        for room_code, poems in boards.items():
+            history = room_histories.get(room_code)
+            if history is None:
+                if poems:
+                    missing.append((room_code, poems))
+                continue
+            
+            # 从文件加载的历史与棋盘是两份对象，按ID换成棋盘中的诗句以免重复占用内存
+            by_id = {poem.id: poem for poem in poems}
+            history_poems = history['poems']
+            for index in range(len(history_poems) - 1, -1, -1):
+                poem = history_poems[index]
+                if poem is None:
+                    break
+                shared = by_id.get(poem.id)
+                if shared is not None and shared.text == poem.text:
+                    history_poems[index] = shared
+    
+    for room_code, poems in missing:
+        for poem in poems:
+            record_history_event(room_code, 'poem', poem, ts=poem.created_at)
+
+def get_board_at(room_code, seq=None, timestamp=None):
+    """从最近的检查点重建指定序号或时间点的棋盘"""
+    with history_lock:
+        history = room_histories.get(room_code)
+        if history is None:
+            history = new_room_history()
+        
+        poems = history['poems']
+        latest_seq = len(poems)
+        if timestamp is not None:
+            seq = bisect_right(history['timestamps'], timestamp)
+        if seq is None:
+            seq = latest_seq
+        seq = max(0, min(seq, latest_seq))
+        event_ts = history['timestamps'][seq - 1] if seq else None
+    
+    # 事件与检查点都只追加，已记录长度后重放无需持锁
+    epoch_start, cells = replay_history(history, seq // HISTORY_CHECKPOINT_INTERVAL, seq)
+    grid = cells_to_grid(cells, lambda number: poems[number - 1])
+    
+    return {
+        'seq': seq,
+        'latest_seq': latest_seq,
+        'timestamp': event_ts,
+        'poems': [poem.to_dict() for poem in poems[epoch_start:seq] if poem is not None],
+        'grid': grid
+    }
 
 # WebSocket事件处理
 @socketio.on('connect')
@@ -530,6 +1351,7 @@ def handle_connect():
     print(f'用户连接: {request.sid}')
 
 @socketio.on('disconnect')
+@timed_event
 def handle_disconnect():
     """用户断开连接"""
     print(f'用户断开连接: {request.sid}')
@@ -538,11 +1360,10 @@ def handle_disconnect():
         if request.sid in room_data.get('editing_users', {}):
             del room_data['editing_users'][request.sid]
             # 广播编辑状态更新
-            socketio.emit('editing_status_update', {
-                'editing_users': room_data['editing_users']
-            }, room=room_code)
+            broadcast_editing_status(room_code, room_data['editing_users'])
 
 @socketio.on('join_room')
+@timed_event
 def handle_join_room(data):
     """加入房间"""
     room_code = data.get('room_code')
@@ -563,11 +1384,7 @@ def handle_join_room(data):
     
     # 记录在线用户
     with online_users_lock:
-        online_users[request.sid] = {
-            'username': username,
-            'room_code': room_code,
-            'join_time': time.time()
-        }
+        online_users[request.sid] = OnlineUser(username, room_code, time.time())
     
     # 更新房间活动时间
     room_data['last_activity'] = time.time()
@@ -601,6 +1418,7 @@ def handle_join_room(data):
         }, room=room_code)
 
 @socketio.on('leave_room')
+@timed_event
 def handle_leave_room(data):
     """离开房间"""
     room_code = data.get('room_code')
@@ -620,9 +1438,7 @@ def handle_leave_room(data):
         if room_data and request.sid in room_data.get('editing_users', {}):
             del room_data['editing_users'][request.sid]
             # 广播编辑状态更新
-            socketio.emit('editing_status_update', {
-                'editing_users': room_data['editing_users']
-            }, room=room_code)
+            broadcast_editing_status(room_code, room_data['editing_users'])
         
         # 通知房间内其他用户并更新玩家统计
         if username:
@@ -639,8 +1455,12 @@ def handle_leave_room(data):
                 }, room=room_code)
 
 @socketio.on('start_editing')
+@timed_event
 def handle_start_editing(data):
     """开始编辑"""
+    if not consume_rate_token(request.sid, 'start_editing'):
+        return
+    
     room_code = data.get('room_code')
     username = data.get('username')
     position = data.get('position')  # {x, y}
@@ -663,11 +1483,10 @@ def handle_start_editing(data):
     }
     
     # 广播编辑状态更新
-    socketio.emit('editing_status_update', {
-        'editing_users': room_data['editing_users']
-    }, room=room_code)
+    broadcast_editing_status(room_code, room_data['editing_users'])
 
 @socketio.on('stop_editing')
+@timed_event
 def handle_stop_editing(data):
     """停止编辑"""
     room_code = data.get('room_code')
@@ -684,11 +1503,10 @@ def handle_stop_editing(data):
         del room_data['editing_users'][request.sid]
         
         # 广播编辑状态更新
-        socketio.emit('editing_status_update', {
-            'editing_users': room_data['editing_users']
-        }, room=room_code)
+        broadcast_editing_status(room_code, room_data['editing_users'])
 
 @socketio.on('update_editing_position')
+@timed_event
 def handle_update_editing_position(data):
     """更新编辑位置"""
     room_code = data.get('room_code')
@@ -701,17 +1519,67 @@ def handle_update_editing_position(data):
     if not room_data or request.sid not in room_data.get('editing_users', {}):
         return
     
-    # 更新编辑位置
+    # 更新编辑位置（超出速率限制时也保存最新位置，只限制广播）
     room_data['editing_users'][request.sid]['position'] = position
+    throttled = not consume_rate_token(request.sid, 'update_editing_position')
     
-    # 广播编辑状态更新
-    socketio.emit('editing_status_update', {
-        'editing_users': room_data['editing_users']
-    }, room=room_code)
+    # 广播编辑状态更新（高频光标移动合并广播）
+    schedule_editing_broadcast(room_code, room_data['editing_users'], throttled=throttled)
+
+@socketio.on('spectate_room')
+@timed_event
+def handle_spectate_room(data):
+    """以观众身份只读加入房间"""
+    if not consume_rate_token(request.sid, 'spectate_room'):
+        return
+    
+    room_code = data.get('room_code')
+    if not room_code:
+        emit('error', {'message': '房间码不能为空'})
+        return
+    
+    if is_admin_room(room_code):
+        emit('error', {'message': '不能观战管理员房间'})
+        return
+    
+    room_data = get_room_data(room_code)
+    if not room_data:
+        emit('error', {'message': '房间不存在'})
+        return
+    
+    # 切换观战房间时先离开之前的房间
+    previous_room = remove_spectator(request.sid)
+    if previous_room is not None:
+        leave_room(spectator_room(previous_room))
+    
+    join_room(spectator_room(room_code))
+    with spectators_lock:
+        spectators[request.sid] = room_code
+        spectator_counts[room_code] += 1
+    
+    # 发送当前棋盘快照，之后的变化通过 spectator_batch 批量推送
+    emit('spectate_snapshot', {
+        'room_code': room_code,
+        'poems': [poem.to_dict() for poem in list(room_data['game_data'].poems)],
+        'players': list(room_data['players']),
+        'batch_interval': SPECTATOR_BATCH_INTERVAL
+    })
+
+@socketio.on('stop_spectating')
+@timed_event
+def handle_stop_spectating(data):
+    """退出观战"""
+    room_code = remove_spectator(request.sid)
+    if room_code is not None:
+        leave_room(spectator_room(room_code))
 
 @socketio.on('request_admin_rooms_info')
+@timed_event
 def handle_request_admin_rooms_info(data):
     """请求管理员房间信息"""
+    if not consume_rate_token(request.sid, 'request_admin_rooms_info'):
+        return
+    
     room_code = data.get('room_code')
     username = data.get('username')
     
@@ -726,15 +1594,18 @@ def handle_request_admin_rooms_info(data):
     })
 
 @socketio.on('disconnect')
+@timed_event
 def handle_disconnect():
     """用户断开连接"""
     print(f'用户断开连接: {request.sid}')
+    forget_socket_limits(request.sid)
+    remove_spectator(request.sid)
     
     # 获取断开连接用户的房间信息
     user_room_code = None
     with online_users_lock:
         if request.sid in online_users:
-            user_room_code = online_users[request.sid]['room_code']
+            user_room_code = online_users[request.sid].room_code
             del online_users[request.sid]
     
     # 清理用户编辑状态
@@ -742,9 +1613,7 @@ def handle_disconnect():
         if request.sid in room_data.get('editing_users', {}):
             del room_data['editing_users'][request.sid]
             # 广播编辑状态更新
-            socketio.emit('editing_status_update', {
-                'editing_users': room_data['editing_users']
-            }, room=room_code)
+            broadcast_editing_status(room_code, room_data['editing_users'])
     
     # 如果用户在某个房间中，广播更新的玩家统计
     if user_room_code and user_room_code in rooms_data:
@@ -760,13 +1629,71 @@ def cleanup_rooms_periodically():
         time.sleep(300)  # 每5分钟检查一次
         cleanup_inactive_rooms()
 
+def flush_editing_broadcasts_periodically():
+    """合并发送被节流的编辑状态，并向已恢复的慢速客户端补发最新状态"""
+    while True:
+        time.sleep(EDITING_BROADCAST_INTERVAL)
+        now = time.monotonic()
+        with editing_broadcast_lock:
+            due_rooms = [room_code for room_code, due in pending_editing_rooms.items() if due <= now]
+            recovered = [(sid, room_code) for sid, room_code in lagging_sockets.items()
+                         if get_outbound_backlog(sid) < OUTBOUND_QUEUE_LIMIT // 2]
+            for sid, _ in recovered:
+                del lagging_sockets[sid]
+        
+        for room_code in due_rooms:
+            room_data = get_room_data(room_code)
+            if room_data:
+                broadcast_editing_status(room_code, room_data.get('editing_users', {}))
+            else:
+                with editing_broadcast_lock:
+                    pending_editing_rooms.pop(room_code, None)
+        
+        for sid, room_code in recovered:
+            room_data = get_room_data(room_code)
+            if room_data:
+                socketio.emit('editing_status_update', {
+                    'editing_users': room_data.get('editing_users', {})
+                }, to=sid)
+
+def flush_spectator_batches_periodically():
+    """按固定频率向观众推送批量的棋盘变化，每个房间每次只广播一次，由Socket.IO对同一数据包编码一次后发给全部观众"""
+    while True:
+        time.sleep(SPECTATOR_BATCH_INTERVAL)
+        with spectators_lock:
+            batches = [(room_code, events, spectator_counts.get(room_code, 0))
+                       for room_code, events in spectator_pending.items() if events]
+            spectator_pending.clear()
+        
+        for room_code, events, count in batches:
+            if not count:
+                continue
+            socketio.emit('spectator_batch', {
+                'room_code': room_code,
+                'events': events,
+                'spectator_count': count
+            }, room=spectator_room(room_code))
+
+# 加载棋盘历史（导入时只读执行，bt_config.py 等部署入口同样生效，新事件接续已有序号）
+init_room_histories()
+
 # 启动清理线程
-import threading
 cleanup_thread = threading.Thread(target=cleanup_rooms_periodically, daemon=True)
 cleanup_thread.start()
 
+# 启动编辑状态合并广播线程
+editing_flush_thread = threading.Thread(target=flush_editing_broadcasts_periodically, daemon=True)
+editing_flush_thread.start()
+
+# 启动观众批量推送线程
+spectator_flush_thread = threading.Thread(target=flush_spectator_batches_periodically, daemon=True)
+spectator_flush_thread.start()
+
 if __name__ == '__main__':
     # 加载房间数据
     rooms_data.update(load_rooms_data())
+    compact_room_histories()
+    seed_room_histories()
+    init_poetry_corpus()
     socketio.run(app, debug=True, host='0.0.0.0', port=5000)
 
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+核心房间操作微基准测试
+
+对 app.py 中的热点函数分别计时，按房间数、每房间诗句数、在线socket数参数化，
+结果可输出为JSON，并可与之前保存的结果对比，超过阈值的性能回退会被标出。
+
+用法示例：
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json --threshold 0.1
+"""
+
+import argparse
+import copy
+import itertools
+import json
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+# 数据文件写入临时目录，避免读取或覆盖真实数据；app 导入时即加载历史文件，必须在导入前设置
+WORKDIR = tempfile.mkdtemp(prefix='jianbing_bench_')
+os.environ['ROOMS_FILE'] = os.path.join(WORKDIR, 'rooms_data.json')
+os.environ['HISTORY_FILE'] = os.path.join(WORKDIR, 'rooms_history.jsonl')
+
+import app
+
+# 每个房间的玩家数
+PLAYERS_PER_ROOM = 8
+# 诗句文本样例，按序号轮流使用
+SAMPLE_TEXTS = ['床前明月光', '疑是地上霜', '举头望明月', '低头思故乡', '白日依山尽', '黄河入海流', '欲穷千里目']
+
+
+def room_code_of(index):
+    """按序号生成房间码"""
+    return str(100000 + index)
+
+
+def player_of(index):
+    """按序号生成玩家名"""
+    return f'玩家{index}'
+
+
+def populate(room_count, poem_count, socket_count):
+    """重建内存中的房间、诗句与在线用户数据，最后一次性写入房间文件"""
+    app.rooms_data.clear()
+    app.online_users.clear()
+    app.room_histories.clear()
+
+    for r in range(room_count):
+        room_code = room_code_of(r)
+        room_data = app.rooms_data[room_code] = app.new_room_data(room_code, player_of(0))
+        room_data['players'].extend(player_of(i) for i in range(1, PLAYERS_PER_ROOM))
+
+        board = room_data['game_data']
+        for i in range(poem_count):
+            poem = app.Poem(
+                f'poem_{i + 1:03d}_{int(time.time())}',
+                SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)],
+                'horizontal' if i % 2 == 0 else 'vertical',
+                (i * 7) % 94,
+                (i * 13) % 94,
+                '#ff6b6b',
+                [],
+                player_of(i % PLAYERS_PER_ROOM)
+            )
+            board.poems.append(poem)
+            app.update_grid(board, poem, len(board.poems))
+
+    for s in range(socket_count):
+        room_code = room_code_of(s % room_count)
+        player = player_of((s // room_count) % PLAYERS_PER_ROOM)
+        app.online_users[f'bench_sid_{s}'] = app.OnlineUser(player, room_code, time.time())
+
+    app.save_rooms_data()
+
+
+def measure(func, repeat, min_time, teardown=None):
+    """自动确定每轮调用次数后重复计时，返回 (每轮次数, 每次调用耗时列表/秒)
+
+    指定teardown时逐次计时，每次调用后执行teardown恢复状态，其耗时不计入结果。
+    """
+    def time_round(number):
+        if teardown is None:
+            start = time.perf_counter()
+            for _ in range(number):
+                func()
+            return time.perf_counter() - start
+
+        elapsed = 0.0
+        for _ in range(number):
+            start = time.perf_counter()
+            func()
+            elapsed += time.perf_counter() - start
+            teardown()
+        return elapsed
+
+    number = 1
+    while True:
+        elapsed = time_round(number)
+        if elapsed >= min_time or number >= 1 << 20:
+            break
+        number *= 2
+
+    timings = [elapsed / number]
+    for _ in range(repeat - 1):
+        timings.append(time_round(number) / number)
+    return number, timings
+
+
+def build_benchmarks():
+    """返回 {基准名: 无参可调用对象 或 (可调用对象, 恢复函数)}，需在 populate() 之后调用"""
+    target = room_code_of(0)
+    board = app.rooms_data[target]['game_data']
+    last_poem = board.poems[-1] if board.poems else app.Poem('poem_bench', SAMPLE_TEXTS[0], 'horizontal', 0, 0, '#ff6b6b')
+    last_number = max(len(board.poems), 1)
+
+    client = app.app.test_client()
+    client.post('/api/register', json={'username': player_of(0)})
+    i = len(board.poems)
+    poem_json = {
+        'text': SAMPLE_TEXTS[i % len(SAMPLE_TEXTS)],
+        'direction': 'horizontal' if i % 2 == 0 else 'vertical',
+        'startPosition': {'x': (i * 7) % 94, 'y': (i * 13) % 94},
+        'color': '#4ecdc4',
+        'connectedTo': []
+    }
+
+    # 记录目标房间的初始状态，add_poem 每次调用后恢复，保证每次测量的工作量相同
+    poem_count = len(board.poems)
+    cells = copy.copy(board.cells)
+    history = app.room_histories.get(target)
+    history_sizes = history and (len(history['poems']), len(history['checkpoints']))
+    history_file_size = os.path.getsize(app.HISTORY_FILE) if os.path.exists(app.HISTORY_FILE) else 0
+
+    def add_poem():
+        client.post(f'/api/poems/{target}', json=poem_json)
+
+    def restore_room():
+        with app.rooms_lock:
+            del board.poems[poem_count:]
+            board.cells = copy.copy(cells)
+        with app.history_lock:
+            if history is None:
+                app.room_histories.pop(target, None)
+            else:
+                event_count, checkpoint_count = history_sizes
+                del history['poems'][event_count:]
+                del history['timestamps'][event_count:]
+                del history['checkpoints'][checkpoint_count:]
+            os.truncate(app.HISTORY_FILE, history_file_size)
+
+    return {
+        'update_grid': lambda: app.update_grid(board, last_poem, last_number),
+        'get_player_stats': lambda: app.get_player_stats(target),
+        'get_online_users_in_room': lambda: app.get_online_users_in_room(target),
+        'get_all_rooms_info': app.get_all_rooms_info,
+        # 所有房间均为活跃状态，只测量扫描开销，不会删除数据
+        'cleanup_inactive_rooms': app.cleanup_inactive_rooms,
+        'save_rooms_data': app.save_rooms_data,
+        'load_rooms_data': app.load_rooms_data,
+        # 每次调用后撤销新增的诗句、网格与历史，房间大小保持不变
+        'add_poem': (add_poem, restore_room),
+    }
+
+
+def run(args):
+    """按参数组合执行所有基准，返回结果字典"""
+    results = []
+    for room_count, poem_count, socket_count in itertools.product(args.rooms, args.poems, args.sockets):
+        populate(room_count, poem_count, socket_count)
+        benchmarks = build_benchmarks()
+        for name, func in benchmarks.items():
+            if args.only and name not in args.only:
+                continue
+            func, teardown = func if isinstance(func, tuple) else (func, None)
+            number, timings = measure(func, args.repeat, args.min_time, teardown)
+            result = {
+                'name': name,
+                'rooms': room_count,
+                'poems': poem_count,
+                'sockets': socket_count,
+                'number': number,
+                'min_us': round(min(timings) * 1e6, 3),
+                'median_us': round(statistics.median(timings) * 1e6, 3)
+            }
+            results.append(result)
+            print(f"{name:<26} rooms={room_count:<5} poems={poem_count:<5} sockets={socket_count:<6} "
+                  f"median={result['median_us']:>12.1f}us  min={result['min_us']:>12.1f}us")
+
+    return {
+        'meta': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': datetime.now().isoformat(),
+            'repeat': args.repeat
+        },
+        'results': results
+    }
+
+
+def compare(current, baseline, threshold):
+    """对比两次结果的中位数，返回超过阈值的回退列表"""
+    def key(result):
+        return result['name'], result['rooms'], result['poems'], result['sockets']
+
+    previous = {key(result): result for result in baseline['results']}
+    regressions = []
+    print(f"\n{'基准':<26} {'参数':<24} {'之前(us)':>12} {'现在(us)':>12} {'变化':>8}")
+    for result in current['results']:
+        old = previous.get(key(result))
+        if old is None or not old['median_us']:
+            continue
+        change = result['median_us'] / old['median_us'] - 1
+        params = f"{result['rooms']}/{result['poems']}/{result['sockets']}"
+        flag = ''
+        if change > threshold:
+            flag = '  <-- 回退'
+            regressions.append({**result, 'baseline_median_us': old['median_us'], 'change': round(change, 4)})
+        print(f"{result['name']:<26} {params:<24} {old['median_us']:>12.1f} {result['median_us']:>12.1f} "
+              f"{change:>+8.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='核心房间操作微基准测试')
+    parser.add_argument('--rooms', type=int, nargs='+', default=[10, 200], help='房间数（可多个）')
+    parser.add_argument('--poems', type=int, nargs='+', default=[20, 200], help='每个房间的诗句数（可多个）')
+    parser.add_argument('--sockets', type=int, nargs='+', default=[10, 500], help='在线socket数（可多个）')
+    parser.add_argument('--only', nargs='+', help='只运行指定名称的基准')
+    parser.add_argument('--repeat', type=int, default=5, help='每个基准重复测量轮数')
+    parser.add_argument('--min-time', type=float, default=0.05, help='每轮最短测量时间（秒）')
+    parser.add_argument('--output', help='将结果写入JSON文件')
+    parser.add_argument('--compare', help='与之前保存的JSON结果对比')
+    parser.add_argument('--threshold', type=float, default=0.1, help='中位数变慢超过该比例视为回退')
+    args = parser.parse_args()
+
+    app.SLOW_REQUEST_THRESHOLD = float('inf')
+
+    try:
+        current = run(args)
+    finally:
+        shutil.rmtree(WORKDIR, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(current, f, ensure_ascii=False, indent=2)
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(current, baseline, args.threshold)
+        if regressions:
+            print(f"\n{len(regressions)} 项基准变慢超过 {args.threshold:.0%}")
+            sys.exit(1)
+        print('\n没有超过阈值的回退')
+
+
+if __name__ == '__main__':
+    main()
@@ -6,7 +6,7 @@
 """
 
 import os
-from app import app
+from app import app, compact_room_histories, init_poetry_corpus
 
 if __name__ == '__main__':
     # 生产环境配置
@@ -19,6 +19,12 @@ if __name__ == '__main__':
     # 生产环境主机配置
     host = os.environ.get('HOST', '0.0.0.0')
     
+    # 压缩棋盘历史文件（导入 app 时只读加载）
+    compact_room_histories()
+    
+    # 打开诗词库索引（需预先执行 python poetry_corpus.py 构建）
+    init_poetry_corpus()
+    
     print(f"启动煎饼摊诗词接龙游戏服务器...")
     print(f"访问地址: http://{host}:{port}")
     print(f"按 Ctrl+C 停止服务器")
@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+古诗词库索引
+
+从本地JSON诗词库（chinese-poetry格式：[{"title", "author", "paragraphs"}]）构建紧凑的二进制索引，
+索引文件通过mmap加载，启动时无需解析原始JSON。索引包含：
+- 按UTF-8字节序排序的去重诗句，用于精确匹配和前缀查找
+- 诗句后缀数组，用于子串查找
+- 每句诗的出处（标题、作者）
+
+构建时需要一次性读入并排序全部后缀，内存占用较高，因此服务进程只打开索引，需直接运行本文件离线构建：
+    python poetry_corpus.py poetry_corpus.json
+"""
+
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+from array import array
+
+MAGIC = b'JBPC'
+VERSION = 1
+# magic, version, 诗句数, 出处数, 后缀数, 诗句数据长度, 出处数据长度
+HEADER = struct.Struct('<4sIIIIII')
+HEADER_SIZE = 32
+# 后缀数组中每项为 (诗句序号 << 8) | 字节起点，超过该长度的诗句不参与子串索引
+MAX_SUFFIX_START = 255
+
+# 诗句分隔符与需要忽略的标点
+PUNCTUATION = re.compile(r'[\s，。！？；：、,.!?;:"“”‘’\'《》〈〉（）()\[\]【】「」『』—…·-]+')
+
+
+def split_lines(text):
+    """按标点将文本切分为诗句"""
+    return [line for line in PUNCTUATION.split(text) if line]
+
+
+def build_index(corpus_path, index_path):
+    """从JSON诗词库构建索引文件"""
+    with open(corpus_path, 'r', encoding='utf-8') as f:
+        poems = json.load(f)
+
+    sources = []
+    source_ids = {}
+    line_sources = {}
+    for poem in poems:
+        title = poem.get('title') or poem.get('rhythmic') or ''
+        poet = poem.get('author') or poem.get('poet') or ''
+        paragraphs = poem.get('paragraphs') or poem.get('content') or []
+        if isinstance(paragraphs, str):
+            paragraphs = [paragraphs]
+
+        for paragraph in paragraphs:
+            for line in split_lines(paragraph):
+                if line in line_sources:
+                    continue
+                source_key = (title, poet)
+                if source_key not in source_ids:
+                    source_ids[source_key] = len(sources)
+                    sources.append(source_key)
+                line_sources[line] = source_ids[source_key]
+
+    # 按码点排序与按UTF-8字节排序一致
+    lines = sorted(line_sources)
+    encoded = [line.encode('utf-8') for line in lines]
+
+    line_offsets = array('I', [0])
+    for data in encoded:
+        line_offsets.append(line_offsets[-1] + len(data))
+    line_source_ids = array('I', (line_sources[line] for line in lines))
+
+    source_blobs = [f'{title}\0{poet}'.encode('utf-8') for title, poet in sources]
+    source_offsets = array('I', [0])
+    for data in source_blobs:
+        source_offsets.append(source_offsets[-1] + len(data))
+
+    # 只在字符边界建立后缀
+    suffixes = array('I', (
+        index << 8 | start
+        for index, data in enumerate(encoded)
+        for start in range(min(len(data), MAX_SUFFIX_START + 1))
+        if data[start] & 0xC0 != 0x80
+    ))
+    suffixes = array('I', sorted(suffixes, key=lambda entry: encoded[entry >> 8][entry & 0xFF:]))
+
+    line_blob = b''.join(encoded)
+    source_blob = b''.join(source_blobs)
+
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, VERSION, len(lines), len(sources), len(suffixes),
+                            len(line_blob), len(source_blob)).ljust(HEADER_SIZE, b'\0'))
+        for section in (line_offsets, line_source_ids, source_offsets, suffixes):
+            f.write(section.tobytes())
+        f.write(line_blob)
+        f.write(source_blob)
+    os.replace(tmp_path, index_path)
+
+
+class PoetryCorpus:
+    """基于mmap索引文件的只读诗词库"""
+
+    def __init__(self, index_path):
+        with open(index_path, 'rb') as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, line_count, source_count, suffix_count, line_blob_size, source_blob_size = \
+            HEADER.unpack_from(self._mm, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('诗词库索引格式不匹配')
+
+        view = memoryview(self._mm)
+        position = HEADER_SIZE
+
+        def take_array(count):
+            nonlocal position
+            section = view[position:position + count * 4].cast('I')
+            position += count * 4
+            return section
+
+        self._line_offsets = take_array(line_count + 1)
+        self._line_sources = take_array(line_count)
+        self._source_offsets = take_array(source_count + 1)
+        self._suffixes = take_array(suffix_count)
+        self._line_blob = position
+        self._source_blob = position + line_blob_size
+        self.line_count = line_count
+
+    def _line(self, index):
+        """第index句诗的UTF-8字节"""
+        start = self._line_blob + self._line_offsets[index]
+        end = self._line_blob + self._line_offsets[index + 1]
+        return self._mm[start:end]
+
+    def _suffix(self, position):
+        """后缀数组第position项对应的后缀字节"""
+        entry = self._suffixes[position]
+        line = entry >> 8
+        start = self._line_blob + self._line_offsets[line] + (entry & 0xFF)
+        end = self._line_blob + self._line_offsets[line + 1]
+        return self._mm[start:end]
+
+    def _source(self, index):
+        """第index句诗的出处 (title, poet)"""
+        source = self._line_sources[index]
+        start = self._source_blob + self._source_offsets[source]
+        end = self._source_blob + self._source_offsets[source + 1]
+        title, _, poet = self._mm[start:end].decode('utf-8').partition('\0')
+        return title, poet
+
+    @staticmethod
+    def _lower_bound(count, item_at, key):
+        """二分查找第一个不小于key的位置"""
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            if item_at(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _find_line(self, line):
+        """精确查找诗句序号，不存在返回None"""
+        key = line.encode('utf-8')
+        index = self._lower_bound(self.line_count, self._line, key)
+        if index < self.line_count and self._line(index) == key:
+            return index
+        return None
+
+    def _find_lines(self, text):
+        """文本中每句诗的序号，没有诗句或任一句不在诗词库中返回None"""
+        indexes = [self._find_line(line) for line in split_lines(text)]
+        if not indexes or None in indexes:
+            return None
+        return indexes
+
+    def contains(self, text):
+        """检查文本中的每句诗是否都在诗词库中"""
+        return self._find_lines(text) is not None
+
+    def lookup(self, text):
+        """文本中的每句诗都在诗词库中且出自同一首时返回出处 (title, poet)，否则返回None"""
+        indexes = self._find_lines(text)
+        if indexes is None:
+            return None
+        if len({self._line_sources[index] for index in indexes}) > 1:
+            return None
+        return self._source(indexes[0])
+
+    def _result(self, index):
+        title, poet = self._source(index)
+        return {'line': self._line(index).decode('utf-8'), 'title': title, 'poet': poet}
+
+    def prefix_search(self, prefix, limit=20):
+        """查找以prefix开头的诗句"""
+        key = prefix.encode('utf-8')
+        index = self._lower_bound(self.line_count, self._line, key)
+        results = []
+        while index < self.line_count and len(results) < limit:
+            if not self._line(index).startswith(key):
+                break
+            results.append(self._result(index))
+            index += 1
+        return results
+
+    def substring_search(self, query, limit=20):
+        """查找包含query的诗句"""
+        key = query.encode('utf-8')
+        position = self._lower_bound(len(self._suffixes), self._suffix, key)
+        seen = set()
+        results = []
+        while position < len(self._suffixes) and len(results) < limit:
+            if not self._suffix(position).startswith(key):
+                break
+            index = self._suffixes[position] >> 8
+            if index not in seen:
+                seen.add(index)
+                results.append(self._result(index))
+            position += 1
+        return results
+
+
+def corpus_index_path(corpus_path):
+    """诗词库对应的索引文件路径"""
+    return corpus_path + '.idx'
+
+
+def index_is_current(corpus_path):
+    """索引文件存在且不比诗词库旧"""
+    index_path = corpus_index_path(corpus_path)
+    return os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(corpus_path)
+
+
+def load_corpus(corpus_path):
+    """加载诗词库，索引文件不存在或比诗词库旧时重新构建（大型诗词库构建可能需要数分钟）"""
+    if not index_is_current(corpus_path):
+        build_index(corpus_path, corpus_index_path(corpus_path))
+    return PoetryCorpus(corpus_index_path(corpus_path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        print('用法: python poetry_corpus.py <诗词库JSON文件>')
+        sys.exit(1)
+
+    corpus = load_corpus(sys.argv[1])
+    print(f'索引构建完成，共 {corpus.line_count} 句')